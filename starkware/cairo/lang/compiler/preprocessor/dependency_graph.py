@@ -1,6 +1,25 @@
-from typing import Dict, List, Optional, Set
+from contextlib import contextmanager
+from typing import (
+    Callable,
+    ClassVar,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+)
 
-from starkware.cairo.lang.compiler.ast.code_elements import CodeElementFunction, CodeElementImport
+from starkware.cairo.lang.compiler.ast.code_elements import (
+    CodeBlock,
+    CodeElementConst,
+    CodeElementFunction,
+    CodeElementIf,
+    CodeElementImport,
+    CodeElementScoped,
+    CodeElementWith,
+    CodeElementWithAttr,
+)
 from starkware.cairo.lang.compiler.ast.expr import (
     ExprAssignment,
     ExprDot,
@@ -8,7 +27,8 @@ from starkware.cairo.lang.compiler.ast.expr import (
     ExprNewOperator,
 )
 from starkware.cairo.lang.compiler.ast.module import CairoModule
-from starkware.cairo.lang.compiler.ast.visitor import Visitor
+from starkware.cairo.lang.compiler.ast.node import AstNode
+from starkware.cairo.lang.compiler.ast.visitor import Visitor, get_lang_from_file
 from starkware.cairo.lang.compiler.error_handling import Location
 from starkware.cairo.lang.compiler.identifier_definition import AliasDefinition
 from starkware.cairo.lang.compiler.identifier_manager import (
@@ -20,6 +40,8 @@ from starkware.cairo.lang.compiler.preprocessor.pass_manager import PassManagerC
 from starkware.cairo.lang.compiler.preprocessor.preprocessor_error import PreprocessorError
 from starkware.cairo.lang.compiler.scoped_name import ScopedName
 
+# The function on which every function that uses the new operator depends.
+GET_AP_NAME = ScopedName.from_string("starkware.cairo.lang.compiler.lib.registers.get_ap")
 
 class DependencyGraphVisitor(Visitor):
     """
@@ -27,13 +49,74 @@ class DependencyGraphVisitor(Visitor):
     scope).
     """
 
+    # A cache from an AST node type to the function that handles it (see visit()).
+    _dispatch: ClassVar[Dict[type, Callable]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Each subclass may override visit_* functions, so it needs its own cache.
+        cls._dispatch = {}
+
     def __init__(self, identifiers: IdentifierManager):
         super().__init__()
         self.identifiers = identifiers
-        # A dictionary from a scope name to the list of identifiers it uses.
-        self.visited_identifiers: Dict[ScopedName, List[ScopedName]] = {}
+        # A dictionary from a scope name to the set of identifiers it uses.
+        self.visited_identifiers: Dict[ScopedName, Set[ScopedName]] = {}
         # Tracks the current function being visited.
         self.current_function: Optional[ScopedName] = None
+        # A cache from (accessible scopes, identifier) to the canonical name of the identifier,
+        # since the same identifiers are usually used many times in the same scope.
+        # Autogenerated identifiers that could not be resolved are mapped to None (see
+        # _try_search()), so that the failed search is not repeated.
+        self._canonical_names: Dict[
+            Tuple[Tuple[ScopedName, ...], ScopedName], Optional[ScopedName]
+        ] = {}
+        # A cache from a dot-separated name to its ScopedName (see _get_scoped_name()).
+        self._scoped_names: Dict[str, ScopedName] = {}
+        # A snapshot of self.accessible_scopes as a tuple, updated on every scope change (see
+        # scoped()), so that it can be used as a cache key.
+        self._accessible_scopes_key: Tuple[ScopedName, ...] = ()
+        # The identifiers used by the current function that were not resolved yet, as a dictionary
+        # from (accessible scopes, identifier) to the location of its first use.
+        self._pending_identifiers: Dict[
+            Tuple[Tuple[ScopedName, ...], ScopedName], Optional[Location]
+        ] = {}
+
+    def visit(self, obj):
+        """
+        Same as Visitor.visit(), except that the handler of each node type is looked up only once,
+        instead of formatting its name and calling getattr() for every visited node.
+        """
+        obj_type = type(obj)
+        func = self._dispatch.get(obj_type)
+        if func is None:
+            cls = type(self)
+            func = getattr(cls, f"visit_{obj_type.__name__}", cls._visit_default)
+            self._dispatch[obj_type] = func
+        return func(self, obj)
+
+    def _get_scoped_name(self, name: str) -> ScopedName:
+        """
+        Same as ScopedName.from_string(), except that the name is split only once for repeated
+        calls with the same name, since the same identifiers are used many times in the code.
+        """
+        scoped_name = self._scoped_names.get(name)
+        if scoped_name is None:
+            scoped_name = self._scoped_names[name] = ScopedName.from_string(name)
+        return scoped_name
+
+    @contextmanager
+    def scoped(self, new_scope: ScopedName, parent: Optional[AstNode]):
+        """
+        Same as Visitor.scoped(), except that self._accessible_scopes_key is updated as well.
+        """
+        with super().scoped(new_scope, parent=parent):
+            old_accessible_scopes_key = self._accessible_scopes_key
+            self._accessible_scopes_key = old_accessible_scopes_key + (new_scope,)
+            try:
+                yield
+            finally:
+                self._accessible_scopes_key = old_accessible_scopes_key
 
     def _visit_default(self, obj):
         # print("# [debug] obj is: {}".format(str(obj)))
@@ -44,28 +127,87 @@ class DependencyGraphVisitor(Visitor):
     def add_identifier(
         self, name: ScopedName, location: Optional[Location], is_resolved: bool = False
     ):
+        if self.current_function is None:
+            # Identifiers used outside of a function are not a dependency of any function.
+            # Their resolution is verified by the later stages.
+            return
         if name.path[-1] == "_":
             return
         if is_resolved:
-            canonical_name = name
-        else:
-            try:
-                canonical_name = self.identifiers.search(
-                    accessible_scopes=self.accessible_scopes, name=name
-                ).canonical_name
-            except (MissingIdentifierError, NotAnIdentifierError) as e:
-                # Don't generate errors on identifiers starting with "__", since they may refer to
-                # autogenerated identifiers which were not collected in the identifier collection
-                # phase.
-                if name.path[-1].startswith("__"):
-                    return
-                raise PreprocessorError(str(e), location=location)
-
-        if self.current_function is not None:
-            self.visited_identifiers.setdefault(self.current_function, []).append(canonical_name)
-
-    def visit_CodeElementMember(self, elm):
-        pass
+            self.visited_identifiers.setdefault(self.current_function, set()).add(name)
+            return
+        # The identifier is resolved when the visit of the current function ends (see
+        # _resolve_pending_identifiers()). Only the first location of each identifier is kept.
+        self._pending_identifiers.setdefault((self._accessible_scopes_key, name), location)
+
+    def _resolve_pending_identifiers(self, function_name: ScopedName):
+        """
+        Resolves the identifiers collected by add_identifier() while visiting the given function
+        (each distinct identifier only once), and adds them to the function's dependencies.
+        """
+        add_function_identifier = self.visited_identifiers.setdefault(function_name, set()).add
+        canonical_names = self._canonical_names
+        try_search = self._try_search
+        for cache_key, location in self._pending_identifiers.items():
+            if cache_key in canonical_names:
+                canonical_name = canonical_names[cache_key]
+            else:
+                accessible_scopes, name = cache_key
+                canonical_name = canonical_names[cache_key] = try_search(
+                    accessible_scopes=accessible_scopes, name=name, location=location
+                )
+            if canonical_name is not None:
+                add_function_identifier(canonical_name)
+
+    def _try_search(
+        self,
+        accessible_scopes: Tuple[ScopedName, ...],
+        name: ScopedName,
+        location: Optional[Location],
+    ) -> Optional[ScopedName]:
+        """
+        Returns the canonical name of the given identifier, or None if it is an autogenerated
+        identifier that cannot be resolved yet.
+        """
+        try:
+            return self.identifiers.search(
+                accessible_scopes=list(accessible_scopes), name=name
+            ).canonical_name
+        except (MissingIdentifierError, NotAnIdentifierError) as e:
+            # Don't generate errors on identifiers starting with "__", since they may refer to
+            # autogenerated identifiers which were not collected in the identifier collection
+            # phase.
+            if name.path[-1].startswith("__"):
+                return None
+            raise PreprocessorError(str(e), location=location)
+
+    def _visit_no_dependencies(self, obj):
+        """
+        Handles nodes that cannot contain identifiers on which the current function depends
+        (declarations of members, types, labels and local names, hints and literals), so that
+        their subtrees are not visited.
+        """
+
+    visit_CodeElementMember = _visit_no_dependencies
+    visit_CodeElementTypeDef = _visit_no_dependencies
+    visit_CodeElementLabel = _visit_no_dependencies
+    visit_CodeElementHint = _visit_no_dependencies
+    visit_CodeElementEmptyLine = _visit_no_dependencies
+    visit_CodeElementDirective = _visit_no_dependencies
+    visit_CodeElementAllocLocals = _visit_no_dependencies
+    visit_TypedIdentifier = _visit_no_dependencies
+    visit_TypeFelt = _visit_no_dependencies
+    visit_TypeCodeoffset = _visit_no_dependencies
+    visit_TypePointer = _visit_no_dependencies
+    visit_TypeStruct = _visit_no_dependencies
+    visit_TypeTuple = _visit_no_dependencies
+    visit_ExprConst = _visit_no_dependencies
+    visit_ExprHint = _visit_no_dependencies
+    visit_ExprReg = _visit_no_dependencies
+
+    def visit_CodeElementConst(self, elm: CodeElementConst):
+        # We override the default visitor, since we must not visit elm.identifier.
+        self.visit(elm.expr)
 
     def visit_ExprDot(self, expr: ExprDot):
         # We override the default visitor, since we must not visit expr.member.
@@ -79,40 +221,89 @@ class DependencyGraphVisitor(Visitor):
                 "The new operator is not supported outside of a function.", location=expr.location
             )
 
-        super().visit(expr.expr)
+        self.visit(expr.expr)
 
         self.add_identifier(
-            name=ScopedName.from_string("starkware.cairo.lang.compiler.lib.registers.get_ap"),
+            name=GET_AP_NAME,
             location=expr.location,
             is_resolved=True,
         )
 
+    # The following functions override the ones of Visitor without constructing a new AST, since
+    # this visitor only reads it.
+
+    def visit_CairoModule(self, module: CairoModule):
+        with self.scoped(module.module_name, parent=module), self.with_file_lang(
+            get_lang_from_file(module.cairo_file)
+        ):
+            self.visit(module.cairo_file.code_block)
+
+    def visit_CodeBlock(self, elm: CodeBlock):
+        visit = self.visit
+        for commented_code_elm in elm.code_elements:
+            visit(commented_code_elm.code_elm)
+
+    def visit_CodeElementScoped(self, elm: CodeElementScoped):
+        visit = self.visit
+        with self.scoped(elm.scope, parent=elm):
+            for code_elm in elm.code_elements:
+                visit(code_elm)
+
+    def visit_CodeElementIf(self, elm: CodeElementIf):
+        self.visit(elm.main_code_block)
+        if elm.else_code_block is not None:
+            self.visit(elm.else_code_block)
+
+    def visit_CodeElementWithAttr(self, elm: CodeElementWithAttr):
+        self.visit(elm.code_block)
+
+    def visit_CodeElementWith(self, elm: CodeElementWith):
+        self.visit(elm.code_block)
+
     def visit_CodeElementFunction(self, elm: CodeElementFunction):
         if elm.element_type == "func":
             # Update self.current_function.
             old_current_function = self.current_function
+            old_pending_identifiers = self._pending_identifiers
+            function_name = self.current_scope + elm.name
             try:
-                self.current_function = self.current_scope + elm.name
+                self.current_function = function_name
+                self._pending_identifiers = {}
                 # Enforce that every function appears in visited_identifiers.
-                self.visited_identifiers.setdefault(self.current_scope + elm.name, [])
-                super().visit_CodeElementFunction(elm)
+                self.visited_identifiers.setdefault(function_name, set())
+                self._visit_code_block_in_scope(elm, scope=function_name)
+                self._resolve_pending_identifiers(function_name)
             finally:
                 self.current_function = old_current_function
-        else:
-            super().visit_CodeElementFunction(elm)
+                self._pending_identifiers = old_pending_identifiers
+        elif elm.element_type != "struct":
+            self._visit_code_block_in_scope(elm, scope=self.current_scope + elm.name)
+
+    def _visit_code_block_in_scope(self, elm: CodeElementFunction, scope: ScopedName):
+        """
+        Visits the code block of a function or a namespace, inside its scope.
+        Unlike Visitor.visit_CodeElementFunction(), the signature and the decorators are not
+        visited, and no new code element is constructed.
+        """
+        with self.scoped(scope, parent=elm):
+            self.visit(elm.code_block)
 
     def visit_ExprAssignment(self, elm: ExprAssignment):
         # We override the default visitor, since we must not visit expr.identifier.
         self.visit(elm.expr)
 
     def visit_ExprIdentifier(self, expr: ExprIdentifier):
-        self.add_identifier(ScopedName.from_string(expr.name), location=expr.location)
+        name = expr.name
+        # Check for the "_" placeholder before constructing a ScopedName (see add_identifier()).
+        if name == "_" or name.endswith("._"):
+            return
+        self.add_identifier(self._get_scoped_name(name), location=expr.location)
 
     def visit_CodeElementImport(self, code_elm: CodeElementImport):
+        module_name = self._get_scoped_name(code_elm.path.name)
         for import_item in code_elm.import_items:
             self.add_identifier(
-                ScopedName.from_string(code_elm.path.name)
-                + ScopedName.from_string(import_item.orig_identifier.name),
+                module_name + self._get_scoped_name(import_item.orig_identifier.name),
                 is_resolved=True,
                 location=code_elm.location,
             )
@@ -121,35 +312,48 @@ class DependencyGraphVisitor(Visitor):
         """
         Finds all the transitive dependencies of a given set of functions.
         """
-        finder = FunctionDependencyFinder(self.visited_identifiers)
-        for x in functions:
-            if x not in self.visited_identifiers:
+        identifier_dependencies = self.visited_identifiers
+        # Use an explicit stack rather than recursion, to support deep dependency chains.
+        stack = [name for name in functions if name in identifier_dependencies]
+        visited: Set[ScopedName] = set()
+        visited_add = visited.add
+        # A cache from an identifier to the function that contains it (see
+        # get_containing_function()), since the same identifiers are used by many functions.
+        containing_function: Dict[ScopedName, Optional[ScopedName]] = {
+            name: name for name in identifier_dependencies
+        }
+        functions_by_path = {name.path: name for name in identifier_dependencies}
+        while len(stack) > 0:
+            name = stack.pop()
+            if name in visited:
                 continue
-            finder.visit(x)
-        return finder.visited
+            visited_add(name)
+            for identifier in identifier_dependencies[name]:
+                if identifier in containing_function:
+                    function = containing_function[identifier]
+                else:
+                    function = containing_function[identifier] = get_containing_function(
+                        name=identifier, functions_by_path=functions_by_path
+                    )
+                if function is not None and function not in visited:
+                    stack.append(function)
+        return visited
 
 
-class FunctionDependencyFinder:
+def get_containing_function(
+    name: ScopedName, functions_by_path: Mapping[Tuple[str, ...], ScopedName]
+) -> Optional[ScopedName]:
     """
-    A class helper for find_function_dependencies.
+    Returns the largest prefix of name that is a function, or None if there is no such prefix.
+    functions_by_path maps the path of each function to its name, so that the prefixes are
+    checked without constructing a ScopedName for each of them.
     """
-
-    def __init__(self, identifer_dependencies: Dict[ScopedName, List[ScopedName]]):
-        self.identifer_dependencies = identifer_dependencies
-        self.visited: Set[ScopedName] = set()
-
-    def visit(self, name: ScopedName):
-        # Find the largest prefix that is a function.
-        while len(name.path) > 0 and name not in self.identifer_dependencies:
-            name = name[:-1]
-        if name not in self.identifer_dependencies:
-            # No such function.
-            return
-        if name in self.visited:
-            return
-        self.visited.add(name)
-        for identifier in self.identifer_dependencies[name]:
-            self.visit(identifier)
+    path = name.path
+    for length in range(len(path), 0, -1):
+        function = functions_by_path.get(path[:length])
+        if function is not None:
+            return function
+    return None
 
 
 def get_main_functions_to_compile(
@@ -168,10 +372,12 @@ def get_main_functions_to_compile(
             continue
 
         main_functions |= {parent_scope + name for name in scope.subscopes}
+        # AliasDefinition has no subclasses, so an exact type check suffices (and is faster than
+        # isinstance() on large identifier tables).
         main_functions |= {
             identifier_definition.destination
             for identifier_definition in scope.identifiers.values()
-            if isinstance(identifier_definition, AliasDefinition)
+            if type(identifier_definition) is AliasDefinition
         }
     return main_functions
 